@@ -248,6 +248,11 @@ VIZ_TYPE_BLACKLIST = []
 
 DRUID_DATA_SOURCE_BLACKLIST = []
 
+# Minimum number of seconds between two metadata refreshes of the same
+# druid cluster, refresh requests made sooner skip that cluster. Scanning
+# for new datasources is not affected. 0 disables the check
+DRUID_METADATA_REFRESH_MIN_INTERVAL = 30
+
 # --------------------------------------------------
 # Modules, datasources and middleware to be registered
 # --------------------------------------------------
@@ -35,7 +35,7 @@ import sqlalchemy as sa
 from sqlalchemy import (
     Boolean, Column, DateTime, ForeignKey, Integer, String, Text, UniqueConstraint,
 )
-from sqlalchemy.orm import backref, relationship
+from sqlalchemy.orm import backref, relationship, selectinload
 
 from superset import conf, db, import_util, security_manager, utils
 from superset.connectors.base.models import BaseColumn, BaseDatasource, BaseMetric
@@ -153,11 +153,15 @@ class DruidCluster(Model, AuditMixinNullable, ImportMixin):
             self,
             datasource_name=None,
             merge_flag=True,
-            refreshAll=True):
+            refreshAll=True,
+            ds_list=None):
         """Refresh metadata of all datasources in the cluster
         If ``datasource_name`` is specified, only that datasource is updated
+        If ``ds_list`` is specified, it is used instead of fetching the
+        list of datasources from the broker
         """
-        ds_list = self.get_datasources()
+        if ds_list is None:
+            ds_list = self.get_datasources()
         blacklist = conf.get('DRUID_DATA_SOURCE_BLACKLIST', [])
         ds_refresh = []
         if not datasource_name:
@@ -179,6 +183,10 @@ class DruidCluster(Model, AuditMixinNullable, ImportMixin):
             .filter(DruidDatasource.cluster_name == self.cluster_name)
             .filter(DruidDatasource.datasource_name.in_(datasource_names))
         )
+        if refreshAll:
+            # ``refresh_metrics`` below walks every datasource's columns, when
+            # only scanning for new ones the existing datasources are dropped
+            ds_list = ds_list.options(selectinload(DruidDatasource.columns))
         ds_map = {ds.name: ds for ds in ds_list}
         for ds_name in datasource_names:
             datasource = ds_map.get(ds_name, None)
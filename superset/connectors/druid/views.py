@@ -5,20 +5,20 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import unicode_literals
 
-from datetime import datetime
+from datetime import datetime, timedelta
 import json
 import logging
+from multiprocessing.pool import ThreadPool
 
 from flask import flash, Markup, redirect
 from flask_appbuilder import CompactCRUDMixin, expose
 from flask_appbuilder.models.sqla.interface import SQLAInterface
 from flask_appbuilder.security.decorators import has_access
-from flask_babel import gettext as __
 from flask_babel import lazy_gettext as _
+import sqlalchemy as sa
 
-from superset import appbuilder, db, security_manager, utils
+from superset import appbuilder, conf, db, security_manager, utils
 from superset.connectors.base.views import DatasourceModelView
-from superset.connectors.connector_registry import ConnectorRegistry
 from superset.views.base import (
     BaseSupersetView, DatasourceFilter, DeleteMixin,
     get_datasource_exist_error_msg, ListWidgetWithCheckboxes, SupersetModelView,
@@ -27,6 +27,18 @@ from superset.views.base import (
 from . import models
 
 
+def _fetch_datasources_for(cluster):
+    """Returns the cluster's datasource names, or the exception raised
+
+    The exception is logged here, while its traceback is still available
+    """
+    try:
+        return cluster.get_datasources()
+    except Exception as e:
+        logging.exception(e)
+        return e
+
+
 class DruidColumnInlineView(CompactCRUDMixin, SupersetModelView):  # noqa
     datamodel = SQLAInterface(models.DruidColumn)
 
@@ -74,6 +86,12 @@ class DruidColumnInlineView(CompactCRUDMixin, SupersetModelView):  # noqa
     }
 
     def pre_update(self, col):
+        # Only revalidate when the spec or the name it must match changed
+        state = sa.inspect(col)
+        if not any(
+                state.attrs[attr].history.has_changes()
+                for attr in ('dimension_spec_json', 'column_name')):
+            return
         # If a dimension spec JSON is given, ensure that it is
         # valid JSON and that `outputName` is specified
         if col.dimension_spec_json:
@@ -202,10 +220,10 @@ class DruidClusterModelView(SupersetModelView, DeleteMixin, YamlExportMixin):  #
 appbuilder.add_view(
     DruidClusterModelView,
     name='Druid Clusters',
-    label=__('Druid Clusters'),
+    label=_('Druid Clusters'),
     icon='fa-cubes',
     category='Sources',
-    category_label=__('Sources'),
+    category_label=_('Sources'),
     category_icon='fa-database',
 )
 
@@ -313,9 +331,9 @@ class DruidDatasourceModelView(DatasourceModelView, DeleteMixin, YamlExportMixin
 appbuilder.add_view(
     DruidDatasourceModelView,
     'Druid Datasources',
-    label=__('Druid Datasources'),
+    label=_('Druid Datasources'),
     category='Sources',
-    category_label=__('Sources'),
+    category_label=_('Sources'),
     icon='fa-cube')
 
 
@@ -327,26 +345,131 @@ class Druid(BaseSupersetView):
     def refresh_datasources(self, refreshAll=True):
         """endpoint that refreshes druid datasources metadata"""
         session = db.session()
-        DruidCluster = ConnectorRegistry.sources['druid'].cluster_class
-        for cluster in session.query(DruidCluster).all():
-            cluster_name = cluster.cluster_name
-            try:
-                cluster.refresh_datasources(refreshAll=refreshAll)
-            except Exception as e:
+        refreshed_ids = []
+        refreshed_names = []
+        error_msg = None
+        clusters = (
+            session.query(models.DruidCluster)
+            .order_by(models.DruidCluster.id)
+            .all()
+        )
+        previous_stamps = {}
+        claimed_at = None
+        min_interval = conf.get('DRUID_METADATA_REFRESH_MIN_INTERVAL', 0)
+        if refreshAll and min_interval:
+            claimed_at, clusters, previous_stamps, skipped_names = (
+                self._claim_clusters(session, clusters, min_interval))
+            if skipped_names:
                 flash(
-                    "Error while processing cluster '{}'\n{}".format(
-                        cluster_name, utils.error_msg_from_exception(e)),
-                    'danger')
-                logging.exception(e)
-                return redirect('/druidclustermodelview/list/')
-            cluster.metadata_last_refreshed = datetime.now()
+                    _('Skipped recently refreshed cluster [{}]').format(
+                        ', '.join(skipped_names)),
+                    'info')
+        ds_lists = []
+        if clusters:
+            # Listing datasources is network bound and independent per
+            # cluster, fetch those concurrently and keep ORM work on this
+            # thread as the session isn't thread safe
+            pool = ThreadPool(min(8, len(clusters)))
+            ds_lists = pool.map(_fetch_datasources_for, clusters)
+            pool.close()
+            pool.join()
+        for cluster, ds_list in zip(clusters, ds_lists):
+            cluster_id, cluster_name = cluster.id, cluster.cluster_name
+            error = ds_list if isinstance(ds_list, Exception) else None
+            if error is None:
+                try:
+                    cluster.refresh_datasources(
+                        refreshAll=refreshAll, ds_list=ds_list)
+                except Exception as e:
+                    logging.exception(e)
+                    error = e
+            if error is not None:
+                error_msg = "Error while processing cluster '{}'\n{}".format(
+                    cluster_name, utils.error_msg_from_exception(error))
+                session.rollback()
+                break
+            refreshed_ids.append(cluster_id)
+            refreshed_names.append(cluster_name)
+        # Release the claims of clusters that weren't refreshed after all,
+        # unless another request has claimed them since
+        for cluster_id, stamp in previous_stamps.items():
+            if cluster_id not in refreshed_ids:
+                (
+                    session.query(models.DruidCluster)
+                    .filter(models.DruidCluster.id == cluster_id)
+                    .filter(
+                        models.DruidCluster.metadata_last_refreshed ==
+                        claimed_at)
+                    .update(
+                        {'metadata_last_refreshed': stamp},
+                        synchronize_session=False)
+                )
+        if refreshed_ids and refreshAll:
+            # Stamp all refreshed clusters with the time the refresh finished,
+            # in a single UPDATE instead of flushing each dirty cluster. A scan
+            # for new datasources doesn't refresh the existing ones, so it
+            # leaves the stamp alone
+            (
+                session.query(models.DruidCluster)
+                .filter(models.DruidCluster.id.in_(refreshed_ids))
+                .update(
+                    {'metadata_last_refreshed': datetime.now()},
+                    synchronize_session=False)
+            )
+        if refreshed_ids:
             flash(
                 _('Refreshed metadata from cluster [{}]').format(
-                    cluster.cluster_name),
+                    ', '.join(refreshed_names)),
                 'info')
         session.commit()
+        if error_msg:
+            flash(error_msg, 'danger')
+            return redirect('/druidclustermodelview/list/')
         return redirect('/druiddatasourcemodelview/list/')
 
+    def _claim_clusters(self, session, clusters, min_interval):
+        """Stamps the clusters not refreshed in the last ``min_interval``
+        seconds and returns the claim time, the claimed clusters, their
+        previous stamps by id and the names of the skipped clusters
+
+        Each claim is a conditional UPDATE committed before any broker call,
+        so overlapping refresh requests can't both claim the same cluster
+        """
+        DruidCluster = models.DruidCluster
+        # Whole seconds, so the stamp still compares equal after a round trip
+        # through a DATETIME column without fractional seconds (MySQL)
+        now = datetime.now().replace(microsecond=0)
+        threshold = now - timedelta(seconds=min_interval)
+        claimed = []
+        previous_stamps = {}
+        skipped_names = []
+        for cluster in clusters:
+            rowcount = (
+                session.query(DruidCluster)
+                .filter(DruidCluster.id == cluster.id)
+                .filter(sa.or_(
+                    DruidCluster.metadata_last_refreshed.is_(None),
+                    DruidCluster.metadata_last_refreshed < threshold))
+                .update(
+                    {'metadata_last_refreshed': now},
+                    synchronize_session=False)
+            )
+            if rowcount == 1:
+                claimed.append(cluster)
+                previous_stamps[cluster.id] = cluster.metadata_last_refreshed
+            else:
+                skipped_names.append(cluster.cluster_name)
+        session.commit()
+        if claimed:
+            # The commit expired the clusters, reload them here rather than
+            # lazily from the broker fetch threads
+            (
+                session.query(DruidCluster)
+                .filter(DruidCluster.id.in_(list(previous_stamps)))
+                .all()
+            )
+        return now, claimed, previous_stamps, skipped_names
+
     @has_access
     @expose('/scan_new_datasources/')
     def scan_new_datasources(self):
@@ -361,18 +484,18 @@ appbuilder.add_view_no_menu(Druid)
 
 appbuilder.add_link(
     'Scan New Datasources',
-    label=__('Scan New Datasources'),
+    label=_('Scan New Datasources'),
     href='/druid/scan_new_datasources/',
     category='Sources',
-    category_label=__('Sources'),
+    category_label=_('Sources'),
     category_icon='fa-database',
     icon='fa-refresh')
 appbuilder.add_link(
     'Refresh Druid Metadata',
-    label=__('Refresh Druid Metadata'),
+    label=_('Refresh Druid Metadata'),
     href='/druid/refresh_datasources/',
     category='Sources',
-    category_label=__('Sources'),
+    category_label=_('Sources'),
     category_icon='fa-database',
     icon='fa-cog')
 
@@ -5,16 +5,19 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import unicode_literals
 
-from datetime import datetime
+from datetime import datetime, timedelta
 import json
 import unittest
 
 from mock import Mock, patch
 
-from superset import db, security_manager
+from superset import app, appbuilder, db, security_manager
 from superset.connectors.druid.models import (
     DruidCluster, DruidColumn, DruidDatasource, DruidMetric,
 )
+from superset.connectors.druid.views import (
+    _fetch_datasources_for, DruidColumnInlineView,
+)
 from .base_tests import SupersetTestCase
 
 
@@ -120,6 +123,34 @@ class DruidTests(SupersetTestCase):
 
         return cluster
 
+    def get_test_clusters(self, *cluster_names):
+        """Recreates never refreshed clusters, in the order given"""
+        for cluster in (
+                db.session.query(DruidCluster)
+                .filter(DruidCluster.cluster_name.in_(cluster_names))):
+            db.session.delete(cluster)
+        db.session.commit()
+
+        clusters = []
+        for cluster_name in cluster_names:
+            cluster = self.get_test_cluster_obj()
+            cluster.cluster_name = cluster_name
+            cluster.metadata_last_refreshed = None
+            db.session.add(cluster)
+            db.session.flush()
+            clusters.append(cluster)
+        db.session.commit()
+        return clusters
+
+    def get_last_refreshed(self, cluster_name):
+        db.session.expire_all()
+        return (
+            db.session.query(DruidCluster)
+            .filter_by(cluster_name=cluster_name)
+            .one()
+            .metadata_last_refreshed
+        )
+
     @patch('superset.connectors.druid.models.PyDruid')
     def test_client(self, PyDruid):
         self.login(username='admin')
@@ -379,6 +410,99 @@ class DruidTests(SupersetTestCase):
                 'double{}'.format(agg.capitalize()),
             )
 
+    @patch.object(
+        DruidCluster, 'get_datasources', autospec=True, return_value=[])
+    @patch.object(DruidCluster, 'refresh_datasources', autospec=True)
+    def test_refresh_metadata_min_interval(
+            self, refresh_datasources, get_datasources):
+        self.login(username='admin')
+        cluster, = self.get_test_clusters('test_cluster')
+
+        def is_refreshed(url, last_refreshed, min_interval):
+            refresh_datasources.reset_mock()
+            cluster.metadata_last_refreshed = last_refreshed
+            db.session.merge(cluster)
+            db.session.commit()
+            config = {'DRUID_METADATA_REFRESH_MIN_INTERVAL': min_interval}
+            with patch.dict(app.config, config):
+                self.client.get(url)
+            return 'test_cluster' in [
+                call[0][0].cluster_name
+                for call in refresh_datasources.call_args_list]
+
+        # Whole seconds, as MySQL DATETIME columns drop fractional seconds
+        now = datetime.now().replace(microsecond=0)
+        recently = now - timedelta(minutes=1)
+        self.assertFalse(
+            is_refreshed('/druid/refresh_datasources/', recently, 3600))
+        self.assertEqual(self.get_last_refreshed('test_cluster'), recently)
+
+        long_ago = now - timedelta(hours=2)
+        self.assertTrue(
+            is_refreshed('/druid/refresh_datasources/', long_ago, 3600))
+        self.assertGreater(self.get_last_refreshed('test_cluster'), long_ago)
+
+        self.assertTrue(is_refreshed('/druid/refresh_datasources/', recently, 0))
+        # Scanning for new datasources ignores the interval, and doesn't
+        # hold off a full refresh either
+        self.assertTrue(
+            is_refreshed('/druid/scan_new_datasources/', recently, 3600))
+        self.assertEqual(self.get_last_refreshed('test_cluster'), recently)
+        self.assertTrue(
+            is_refreshed('/druid/scan_new_datasources/', long_ago, 3600))
+        self.assertEqual(self.get_last_refreshed('test_cluster'), long_ago)
+        refresh_datasources.reset_mock()
+        with patch.dict(
+                app.config, {'DRUID_METADATA_REFRESH_MIN_INTERVAL': 3600}):
+            self.client.get('/druid/refresh_datasources/')
+        self.assertIn(
+            'test_cluster',
+            [call[0][0].cluster_name
+             for call in refresh_datasources.call_args_list])
+
+    @patch.object(
+        DruidCluster, 'get_datasources', autospec=True, return_value=[])
+    @patch.object(DruidCluster, 'refresh_datasources', autospec=True)
+    def test_refresh_metadata_min_interval_releases_claim(
+            self, refresh_datasources, get_datasources):
+        refresh_datasources.side_effect = Exception('Broker unreachable')
+        self.login(username='admin')
+        self.get_test_clusters('test_cluster')
+
+        config = {'DRUID_METADATA_REFRESH_MIN_INTERVAL': 3600}
+        with patch.dict(app.config, config):
+            self.client.get('/druid/refresh_datasources/')
+        # The failed refresh must not hold the cluster for the interval
+        self.assertIsNone(self.get_last_refreshed('test_cluster'))
+
+    @patch.object(
+        DruidCluster, 'get_datasources', autospec=True, return_value=[])
+    @patch.object(DruidCluster, 'refresh_datasources', autospec=True)
+    def test_refresh_metadata_min_interval_keeps_newer_claim(
+            self, refresh_datasources, get_datasources):
+        newer = datetime.now().replace(microsecond=0) + timedelta(minutes=1)
+
+        def refresh(cluster, **kwargs):
+            # Another request claims the cluster while this one is running
+            (
+                db.session.query(DruidCluster)
+                .filter_by(cluster_name='test_cluster')
+                .update(
+                    {'metadata_last_refreshed': newer},
+                    synchronize_session=False)
+            )
+            db.session.commit()
+            raise Exception('Broker unreachable')
+
+        refresh_datasources.side_effect = refresh
+        self.login(username='admin')
+        self.get_test_clusters('test_cluster')
+
+        config = {'DRUID_METADATA_REFRESH_MIN_INTERVAL': 3600}
+        with patch.dict(app.config, config):
+            self.client.get('/druid/refresh_datasources/')
+        self.assertEqual(self.get_last_refreshed('test_cluster'), newer)
+
     @patch('superset.connectors.druid.models.PyDruid')
     def test_refresh_metadata_augment_type(self, PyDruid):
         self.login(username='admin')
@@ -445,6 +569,100 @@ class DruidTests(SupersetTestCase):
         for metric in metrics:
             self.assertEqual(metric.verbose_name, metric.metric_name)
 
+    @patch.object(
+        DruidCluster, 'get_datasources', autospec=True, return_value=[])
+    @patch.object(DruidCluster, 'refresh_datasources', autospec=True)
+    def test_refresh_endpoint_stops_at_failing_cluster(
+            self, refresh_datasources, get_datasources):
+        def refresh(cluster, **kwargs):
+            if cluster.cluster_name == 'test_cluster_broken':
+                raise Exception('Broker unreachable')
+
+        refresh_datasources.side_effect = refresh
+        self.login(username='admin')
+        self.get_test_clusters('test_cluster', 'test_cluster_broken')
+
+        resp = self.client.get('/druid/refresh_datasources/')
+        self.assertEqual(resp.status_code, 302)
+        self.assertTrue(
+            resp.location.endswith('/druidclustermodelview/list/'))
+        self.assertIsNotNone(self.get_last_refreshed('test_cluster'))
+        self.assertIsNone(self.get_last_refreshed('test_cluster_broken'))
+
+    @patch('superset.connectors.druid.models.PyDruid')
+    def test_refresh_with_prefetched_datasources(self, PyDruid):
+        self.login(username='admin')
+        cluster = self.get_cluster(PyDruid)
+        cluster.refresh_datasources(ds_list=['test_datasource'])
+
+        cluster.get_datasources.assert_not_called()
+        self.assertEqual(
+            [ds.datasource_name for ds in cluster.datasources],
+            ['test_datasource'])
+
+    def test_fetch_datasources_for(self):
+        cluster = self.get_test_cluster_obj()
+        cluster.get_datasources = Mock(return_value=['test_datasource'])
+        self.assertEqual(
+            _fetch_datasources_for(cluster), ['test_datasource'])
+
+        error = Exception('Broker unreachable')
+        cluster.get_datasources = Mock(side_effect=error)
+        self.assertIs(_fetch_datasources_for(cluster), error)
+
+    @patch.object(DruidCluster, 'refresh_datasources', autospec=True)
+    @patch.object(DruidCluster, 'get_datasources', autospec=True)
+    def test_refresh_endpoint_failed_fetch(
+            self, get_datasources, refresh_datasources):
+        def fetch(cluster):
+            if cluster.cluster_name == 'test_cluster_broken':
+                raise Exception('Broker unreachable')
+            return []
+
+        get_datasources.side_effect = fetch
+        self.login(username='admin')
+        self.get_test_clusters('test_cluster', 'test_cluster_broken')
+
+        resp = self.client.get('/druid/refresh_datasources/')
+        self.assertTrue(
+            resp.location.endswith('/druidclustermodelview/list/'))
+        refreshed = [
+            call[0][0].cluster_name
+            for call in refresh_datasources.call_args_list]
+        self.assertIn('test_cluster', refreshed)
+        self.assertNotIn('test_cluster_broken', refreshed)
+        self.assertIsNotNone(self.get_last_refreshed('test_cluster'))
+        self.assertIsNone(self.get_last_refreshed('test_cluster_broken'))
+
+    @patch('superset.connectors.druid.models.PyDruid')
+    def test_column_pre_update_validates_changed_spec(self, PyDruid):
+        self.login(username='admin')
+        cluster = self.get_cluster(PyDruid)
+        cluster.refresh_datasources()
+        view = next(
+            v for v in appbuilder.baseviews
+            if isinstance(v, DruidColumnInlineView))
+        col = (
+            db.session.query(DruidColumn)
+            .filter(DruidColumn.datasource_id == cluster.datasources[0].id)
+            .filter(DruidColumn.column_name == 'dim1')
+        ).one()
+
+        # An invalid spec stored earlier isn't revalidated on unrelated edits
+        col.dimension_spec_json = json.dumps({'outputName': 'dim1'})
+        db.session.commit()
+        col.groupby = not col.groupby
+        view.pre_update(col)
+        db.session.rollback()
+
+        col.dimension_spec_json = json.dumps(
+            {'outputName': 'dim1', 'dimension': 'dim1'})
+        db.session.commit()
+        col.column_name = 'dim1_renamed'
+        with self.assertRaises(ValueError):
+            view.pre_update(col)
+        db.session.rollback()
+
     def test_urls(self):
         cluster = self.get_test_cluster_obj()
         self.assertEquals(